@@ -265,10 +265,10 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
             input_mask = [1] * len(input_ids)
 
             # Zero-pad up to the sequence length.
-            while len(input_ids) < max_seq_length:
-                input_ids.append(0)
-                input_mask.append(0)
-                segment_ids.append(0)
+            padding = [0] * (max_seq_length - len(input_ids))
+            input_ids += padding
+            input_mask += padding
+            segment_ids += padding
 
             assert len(input_ids) == max_seq_length
             assert len(input_mask) == max_seq_length
@@ -1,9 +1,17 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
+import numpy as np
 import pytest
+from pytorch_pretrained_bert.tokenization import BertTokenizer as SlowBertTokenizer
 
-from utils_nlp.models.bert.common import create_data_loader
+from utils_nlp.models.bert.common import Language, Tokenizer, create_data_loader
+
+NON_ASCII_TEXT = [
+    "Café naïve Ångström résumé",
+    "中文字符 and 日本語 mixed in",
+    "control\u0007char\u200bhere, tab\tand\nnewline",
+]
 
 
 def test_tokenize(bert_english_tokenizer):
@@ -16,6 +24,51 @@ def test_tokenize(bert_english_tokenizer):
     assert tokens[2][1].startswith("##")
 
 
+def test_tokenize_pair(bert_english_tokenizer):
+    text = [("Hello World.", "How you doing?"), ("greatttt", "Fine.")]
+    tokens = bert_english_tokenizer.tokenize(text)
+    assert len(tokens) == len(text)
+    assert tokens == [bert_english_tokenizer.tokenize(list(example)) for example in text]
+
+
+@pytest.mark.parametrize(
+    "language, to_lower",
+    [
+        (Language.ENGLISHCASED, False),
+        ("bert-base-uncased", True),
+        # a pretrained model that isn't in Language
+        ("bert-base-multilingual-uncased", True),
+    ],
+)
+def test_tokenize_matches_slow_tokenizer(language, to_lower, tmp):
+    tokenizer = Tokenizer(language=language, to_lower=to_lower, cache_dir=tmp)
+    slow_tokenizer = SlowBertTokenizer.from_pretrained(
+        getattr(language, "value", language), do_lower_case=to_lower, cache_dir=tmp
+    )
+
+    expected_tokens = [slow_tokenizer.tokenize(x) for x in NON_ASCII_TEXT]
+    assert tokenizer.tokenize(NON_ASCII_TEXT) == expected_tokens
+    assert tokenizer.encode_batch(NON_ASCII_TEXT) == [
+        slow_tokenizer.convert_tokens_to_ids(x) for x in expected_tokens
+    ]
+
+
+def test_preprocess_classification_tokens(bert_english_tokenizer):
+    tokens = [["Hello", "World", "."], ["not-a-wordpiece-token"]]
+    input_ids, input_mask, _ = bert_english_tokenizer.preprocess_classification_tokens(
+        tokens, max_len=6
+    )
+
+    expected_input_ids = [
+        bert_english_tokenizer.tokenizer.convert_tokens_to_ids(["[CLS]"] + x + ["[SEP]"])
+        for x in tokens
+    ]
+    # unknown tokens are converted to the id of [UNK]
+    assert expected_input_ids[1][1] == bert_english_tokenizer.tokenizer.unk_token_id
+    assert input_ids == [x + [0] * (6 - len(x)) for x in expected_input_ids]
+    assert input_mask == [[1] * len(x) + [0] * (6 - len(x)) for x in expected_input_ids]
+
+
 def test_tokenize_ner(ner_test_data, bert_english_tokenizer):
     seq_length = 20
 
@@ -69,6 +122,36 @@ def test_tokenize_ner(ner_test_data, bert_english_tokenizer):
         )
 
 
+def test_tokenize_ner_repeated_words(bert_english_tokenizer):
+    text = [["criticize", "the", "criticize"], ["the", "Ångström", "criticize", "Ångström"]]
+    max_len = 16
+    expected_input_ids = []
+    for words in text:
+        # tokenize every word without the WordPiece cache
+        tokens = [t for word in words for t in bert_english_tokenizer.tokenizer.tokenize(word)]
+        input_ids = bert_english_tokenizer.tokenizer.convert_tokens_to_ids(tokens)
+        expected_input_ids.append(input_ids + [0] * (max_len - len(input_ids)))
+
+    # the second call gets the tokens of every word from the cache
+    preprocessed_tokens = bert_english_tokenizer.tokenize_ner(text, max_len=max_len)
+    assert preprocessed_tokens[0] == expected_input_ids
+    assert bert_english_tokenizer.tokenize_ner(text, max_len=max_len) == preprocessed_tokens
+
+
+def test_tokenize_ner_return_arrays(ner_test_data, bert_english_tokenizer):
+    tokenize_args = {
+        "text": ner_test_data["INPUT_TEXT"],
+        "labels": ner_test_data["INPUT_LABELS"],
+        "label_map": ner_test_data["LABEL_MAP"],
+        "max_len": 20,
+    }
+    preprocessed_tokens = bert_english_tokenizer.tokenize_ner(**tokenize_args)
+    preprocessed_arrays = bert_english_tokenizer.tokenize_ner(return_arrays=True, **tokenize_args)
+    for values, array in zip(preprocessed_tokens, preprocessed_arrays):
+        assert isinstance(array, np.ndarray)
+        assert array.tolist() == values
+
+
 def test_create_data_loader(ner_test_data):
     with pytest.raises(ValueError):
         create_data_loader(
@@ -91,3 +174,15 @@ def test_create_data_loader(ner_test_data):
         label_ids=ner_test_data["INPUT_LABEL_IDS"],
         sample_method="random",
     )
+
+    # int64 arrays are shared with the tensors instead of being copied
+    input_ids = np.array(ner_test_data["INPUT_TOKEN_IDS"], dtype=np.int64)
+    dataloader = create_data_loader(
+        input_ids=input_ids,
+        input_mask=np.array(ner_test_data["INPUT_MASK"], dtype=np.int64),
+        label_ids=np.array(ner_test_data["INPUT_LABEL_IDS"], dtype=np.int64),
+        sample_method="sequential",
+    )
+    input_ids_tensor, _, label_ids_tensor = dataloader.dataset.tensors
+    assert np.shares_memory(input_ids_tensor.numpy(), input_ids)
+    assert label_ids_tensor.tolist() == ner_test_data["INPUT_LABEL_IDS"]
@@ -3,16 +3,23 @@
 
 import os
 
+import jsonlines
+import pandas as pd
 import pytest
 import torch
+from torch.utils.data import Subset
 
 from utils_nlp.common.pytorch_utils import dataloader_from_dataset
+from utils_nlp.models.transformers.common import TOKENIZER_CLASS
 from utils_nlp.models.transformers.datasets import QADataset
 from utils_nlp.models.transformers.question_answering import (
     CACHED_EXAMPLES_TEST_FILE,
     CACHED_FEATURES_TEST_FILE,
+    CACHED_FEATURES_TRAIN_FILE,
     AnswerExtractor,
     QAProcessor,
+    _tokenize_doc_by_word,
+    _tokenize_doc_with_offsets,
 )
 
 NUM_GPUS = max(1, torch.cuda.device_count())
@@ -184,6 +191,182 @@ def test_QAProcessor(qa_test_data, tmp_module):
         )
 
 
+def _tokenize_on_spaces(text):
+    return text.split()
+
+
+def test_QAProcessor_num_workers(qa_test_data, tmp_module, tmp):
+    qa_processor = QAProcessor(cache_dir=tmp_module)
+    for dataset_name, is_training, features_file in [
+        ("train_dataset", True, CACHED_FEATURES_TRAIN_FILE),
+        ("test_dataset", False, CACHED_FEATURES_TEST_FILE),
+    ]:
+        # the features extracted by two worker processes are the same as the
+        # features extracted serially
+        qa_features = []
+        cached_features = []
+        for num_workers in [1, 2]:
+            feature_cache_dir = os.path.join(tmp, "{}_{}".format(dataset_name, num_workers))
+            qa_features.append(
+                qa_processor.preprocess(
+                    qa_test_data[dataset_name],
+                    is_training=is_training,
+                    max_question_length=16,
+                    max_seq_length=64,
+                    doc_stride=32,
+                    feature_cache_dir=feature_cache_dir,
+                    num_workers=num_workers,
+                )
+            )
+            with jsonlines.open(os.path.join(feature_cache_dir, features_file)) as reader:
+                cached_features.append(list(reader))
+
+        assert len(qa_features[0].tensors) == len(qa_features[1].tensors)
+        for serial_tensor, parallel_tensor in zip(qa_features[0].tensors, qa_features[1].tensors):
+            assert torch.equal(serial_tensor, parallel_tensor)
+        assert cached_features[0] == cached_features[1]
+
+    # test invalid number of workers
+    with pytest.raises(ValueError):
+        qa_processor.preprocess(
+            qa_test_data["test_dataset"], is_training=False, feature_cache_dir=tmp, num_workers=0
+        )
+
+    # test custom_tokenize functions with and without pickle support
+    qa_processor_custom = QAProcessor(cache_dir=tmp_module, custom_tokenize=_tokenize_on_spaces)
+    qa_processor_custom.preprocess(
+        qa_test_data["test_dataset"], is_training=False, feature_cache_dir=tmp, num_workers=2
+    )
+    qa_processor_custom.custom_tokenize = lambda text: text.split()
+    with pytest.raises(ValueError):
+        qa_processor_custom.preprocess(
+            qa_test_data["test_dataset"], is_training=False, feature_cache_dir=tmp, num_workers=2
+        )
+
+
+def test_QAProcessor_subset(qa_test_data, tmp_module, tmp):
+    # any map-style dataset of QA inputs can be preprocessed, not only a QADataset
+    qa_processor = QAProcessor(cache_dir=tmp_module)
+    test_features = qa_processor.preprocess(
+        qa_test_data["test_dataset"],
+        is_training=False,
+        max_question_length=16,
+        max_seq_length=64,
+        doc_stride=32,
+        feature_cache_dir=tmp,
+    )
+    test_features_subset = qa_processor.preprocess(
+        Subset(qa_test_data["test_dataset"], range(len(qa_test_data["test_dataset"]))),
+        is_training=False,
+        max_question_length=16,
+        max_seq_length=64,
+        doc_stride=32,
+        feature_cache_dir=tmp,
+    )
+    for tensor, subset_tensor in zip(test_features.tensors, test_features_subset.tensors):
+        assert torch.equal(tensor, subset_tensor)
+
+    # an empty dataset gives an empty TensorDataset
+    test_features_empty = qa_processor.preprocess(
+        Subset(qa_test_data["test_dataset"], []),
+        is_training=False,
+        max_question_length=16,
+        max_seq_length=64,
+        doc_stride=32,
+        feature_cache_dir=tmp,
+    )
+    assert len(test_features_empty) == 0
+
+
+def test_QAProcessor_long_document(tmp_module, tmp):
+    doc_length = 20
+    test_dataset = QADataset(
+        df=pd.DataFrame(
+            {
+                "doc_text": [" ".join(["the"] * doc_length)],
+                "question_text": ["who?"],
+                "qa_id": ["1"],
+            }
+        ),
+        doc_text_col="doc_text",
+        question_text_col="question_text",
+        qa_id_col="qa_id",
+    )
+    qa_processor = QAProcessor(cache_dir=tmp_module)
+    num_query_tokens = len(qa_processor.tokenizer.tokenize("who?"))
+
+    # the doc spans have 8 tokens and start 4 tokens apart: 0-7, 4-11, 8-15, 12-19
+    test_features = qa_processor.preprocess(
+        test_dataset,
+        is_training=False,
+        max_question_length=16,
+        max_seq_length=num_query_tokens + 3 + 8,
+        doc_stride=4,
+        feature_cache_dir=tmp,
+    )
+    assert len(test_features) == 4
+
+    with jsonlines.open(os.path.join(tmp, CACHED_FEATURES_TEST_FILE)) as reader:
+        features = list(reader)
+    assert len(features) == 4
+
+    # a token has the max context in the span where it is the farthest from the span ends
+    expected_max_context_tokens = [range(0, 6), range(6, 10), range(10, 14), range(14, 20)]
+    # [CLS] + question + [SEP] precede the document tokens
+    doc_offset = num_query_tokens + 2
+    for feature, span_start, expected in zip(
+        features, [0, 4, 8, 12], expected_max_context_tokens
+    ):
+        max_context_tokens = sorted(
+            span_start + int(position) - doc_offset
+            for position, is_max_context in feature["token_is_max_context"].items()
+            if is_max_context
+        )
+        assert max_context_tokens == list(expected)
+
+
+@pytest.mark.parametrize(
+    "model_name, to_lower", [("bert-base-cased", False), ("distilbert-base-uncased", True)]
+)
+def test_tokenize_doc_with_offsets(model_name, to_lower, tmp_module):
+    # accented, CJK, control and format characters, and white spaces that don't
+    # separate the document tokens
+    doc_tokens = [
+        "Café",
+        "naïve",
+        "Ångström",
+        "résumé",
+        "中文字符",
+        "(1895-1943).",
+        "don't",
+        "\u0007",
+        "foo\u0007bar",
+        "\u200b",
+        "soft\u00adhyphen",
+        "no\u00a0break",
+        "end",
+    ]
+    fast_tokenizer = QAProcessor(
+        model_name=model_name, to_lower=to_lower, cache_dir=tmp_module
+    ).tokenizer
+    slow_tokenizer = TOKENIZER_CLASS[model_name].from_pretrained(
+        model_name, do_lower_case=to_lower, cache_dir=tmp_module
+    )
+
+    # the single fast tokenizer call matches tokenizing the words one by one with
+    # the slow tokenizer
+    (
+        all_doc_tokens,
+        tok_to_orig_index,
+        orig_to_tok_index,
+        all_doc_ids,
+    ) = _tokenize_doc_with_offsets(fast_tokenizer, doc_tokens)
+    assert (all_doc_tokens, tok_to_orig_index, orig_to_tok_index) == _tokenize_doc_by_word(
+        slow_tokenizer.tokenize, doc_tokens, {}
+    )
+    assert all_doc_ids == slow_tokenizer.convert_tokens_to_ids(all_doc_tokens)
+
+
 def test_AnswerExtractor(qa_test_data, tmp_module):
     # bert
     qa_extractor_bert = AnswerExtractor(cache_dir=tmp_module)
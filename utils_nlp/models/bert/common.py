@@ -7,14 +7,14 @@
 # /run_glue.py
 
 import csv
+import itertools
 import linecache
 import subprocess
 import warnings
-from collections.abc import Iterable
 from enum import Enum
 
+import numpy as np
 import torch
-from pytorch_pretrained_bert.tokenization import BertTokenizer
 from torch.utils.data import (
     DataLoader,
     Dataset,
@@ -23,10 +23,13 @@ from torch.utils.data import (
     TensorDataset,
     ConcatDataset,
 )
-from tqdm import tqdm
+
+from utils_nlp.models.transformers.common import load_fast_tokenizer
 
 # Max supported sequence length
 BERT_MAX_LEN = 512
+# Max number of distinct words whose WordPiece tokens are cached
+WORDPIECE_CACHE_SIZE = 2 ** 16
 
 
 class Language(str, Enum):
@@ -47,15 +50,52 @@ class Tokenizer:
         """Initializes the underlying pretrained BERT tokenizer.
 
         Args:
-            language (Language, optional): The pretrained model's language.
-                                           Defaults to Language.ENGLISH.
+            language (Language or str, optional): The pretrained model's language,
+                or the name or path of another pretrained BERT model.
+                Defaults to Language.ENGLISH.
+            to_lower (bool, optional): Whether to lower case the input text.
+                Defaults to False.
             cache_dir (str, optional): Location of BERT's cache directory.
                 Defaults to ".".
         """
-        self.tokenizer = BertTokenizer.from_pretrained(
-            language, do_lower_case=to_lower, cache_dir=cache_dir
+        self.tokenizer = load_fast_tokenizer(
+            getattr(language, "value", language), to_lower, cache_dir=cache_dir
         )
         self.language = language
+        # The fast tokenizer converts tokens to ids one at a time, with a call
+        # into the Rust tokenizer for each, so tokens are looked up in a copy
+        # of its vocabulary instead.
+        self._vocab = self.tokenizer._tokenizer.get_vocab()
+        # words repeat a lot across examples, so cache their WordPiece tokens
+        self._wordpiece_cache = {}
+
+    def _tokenize_word(self, word):
+        """Returns the WordPiece tokens of a word as a tuple. The tokens of up to
+            WORDPIECE_CACHE_SIZE distinct words are cached."""
+        sub_words = self._wordpiece_cache.get(word)
+        if sub_words is None:
+            sub_words = tuple(self.tokenizer.tokenize(word))
+            if len(self._wordpiece_cache) < WORDPIECE_CACHE_SIZE:
+                self._wordpiece_cache[word] = sub_words
+        return sub_words
+
+    def encode_batch(self, text):
+        """Converts a list of documents to WordPiece token ids in a single
+            batch call to the underlying fast tokenizer.
+
+        Args:
+            text (list): List of strings.
+
+        Returns:
+            [list]: List of lists. Each sublist contains the WordPiece token
+                ids of the input sequence, without BERT sentence markers.
+        """
+        return self.tokenizer.batch_encode_plus(
+            list(text),
+            add_special_tokens=False,
+            return_token_type_ids=False,
+            return_attention_mask=False,
+        )["input_ids"]
 
     def tokenize(self, text):
         """Tokenizes a list of documents using a BERT tokenizer
@@ -68,30 +108,19 @@ class Tokenizer:
             [list]: List of lists. Each sublist contains WordPiece tokens
                 of the input sequence(s).
         """
+        text = list(text)
         if isinstance(text[0], str):
-            return [self.tokenizer.tokenize(x) for x in tqdm(text)]
+            return [self.tokenizer.convert_ids_to_tokens(x) for x in self.encode_batch(text)]
         else:
-            return [[self.tokenizer.tokenize(x) for x in sentences] for sentences in tqdm(text)]
+            # tokenize all sentences in one batch and regroup them by example
+            tokens = iter(self.tokenize([sentence for example in text for sentence in example]))
+            return [[next(tokens) for _ in example] for example in text]
 
     def _truncate_seq_pair(self, tokens_a, tokens_b, max_length):
         """Truncates a sequence pair in place to the maximum length."""
-        # This is a simple heuristic which will always truncate the longer
-        # sequence one token at a time. This makes more sense than
-        # truncating an equal percent of tokens from each, since if one
-        # sequence is very short then each token that's truncated likely
-        # contains more information than a longer sequence.
-
-        if not tokens_b:
-            max_length += 1
-
-        while True:
-            total_length = len(tokens_a) + len(tokens_b)
-            if total_length <= max_length:
-                break
-            if len(tokens_a) > len(tokens_b):
-                tokens_a.pop()
-            else:
-                tokens_b.pop()
+        len_a, len_b = self._truncated_lengths(len(tokens_a), len(tokens_b), max_length)
+        del tokens_a[len_a:]
+        del tokens_b[len_b:]
 
         tokens_a.append("[SEP]")
 
@@ -123,38 +152,74 @@ class Tokenizer:
             print("setting max_len to max allowed tokens: {}".format(BERT_MAX_LEN))
             max_len = BERT_MAX_LEN
 
-        if isinstance(tokens[0][0], str):
-            tokens = [x[0 : max_len - 2] + ["[SEP]"] for x in tokens]
-            token_type_ids = None
-        else:
-            # get tokens for each sentence [[t00, t01, ...] [t10, t11,... ]]
-            tokens = [
-                self._truncate_seq_pair(sentence[0], sentence[1], max_len - 3)
-                for sentence in tokens
-            ]
+        is_pair = not isinstance(tokens[0][0], str)
+
+        examples = []
+        token_type_ids = [] if is_pair else None
+        # truncate, add sentence markers and build the token type ids
+        for example in tokens:
+            if is_pair:
+                tokens_a, tokens_b = example
+                len_a, len_b = self._truncated_lengths(len(tokens_a), len(tokens_b), max_len - 3)
+                example = ["[CLS]"] + tokens_a[:len_a] + ["[SEP]"]
+                # [0, 0, 0, 0, ... 0, 1, 1, 1, ... 1, 0, 0, ...]
+                type_ids = [0] * len(example)
+                if len_b:
+                    example += tokens_b[:len_b] + ["[SEP]"]
+                    type_ids += [1] * (len_b + 1)
+                token_type_ids.append(type_ids + [0] * (max_len - len(type_ids)))
+            else:
+                example = ["[CLS]"] + example[0 : max_len - 2] + ["[SEP]"]
+            examples.append(example)
 
-            # construct token_type_ids
-            # [[0, 0, 0, 0, ... 0, 1, 1, 1, ... 1], [0, 0, 0, ..., 1, 1, ]
-            token_type_ids = [
-                [[i] * len(sentence) for i, sentence in enumerate(example)] for example in tokens
-            ]
-            # merge sentences
-            tokens = [[token for sentence in example for token in sentence] for example in tokens]
-            # prefix with [0] for [CLS]
-            token_type_ids = [
-                [0] + [i for sentence in example for i in sentence] for example in token_type_ids
-            ]
-            # pad sequence
-            token_type_ids = [x + [0] * (max_len - len(x)) for x in token_type_ids]
+        input_ids, input_mask = self._convert_tokens_to_padded_ids(examples, max_len)
+        return input_ids.tolist(), input_mask.tolist(), token_type_ids
 
-        tokens = [["[CLS]"] + x for x in tokens]
-        # convert tokens to indices
-        tokens = [self.tokenizer.convert_tokens_to_ids(x) for x in tokens]
-        # pad sequence
-        tokens = [x + [0] * (max_len - len(x)) for x in tokens]
-        # create input mask
-        input_mask = [[min(1, x) for x in y] for y in tokens]
-        return tokens, input_mask, token_type_ids
+    def _convert_tokens_to_padded_ids(self, tokens, max_len):
+        """Converts token lists to zero-padded token ids. Tokens that aren't in
+            the vocabulary are converted to the id of the unknown token.
+
+        Args:
+            tokens (list): List of token lists, each at most max_len long.
+            max_len (int): Length of the padded token id sequences.
+
+        Returns:
+            tuple: A tuple containing the following two arrays of shape
+                (len(tokens), max_len)
+                array of token ids
+                array of input masks, 1 for tokens and 0 for padding
+        """
+        lengths = np.array([len(x) for x in tokens], dtype=np.int64)
+        input_mask = np.arange(max_len) < lengths[:, np.newaxis]
+
+        input_ids = np.zeros((len(tokens), max_len), dtype=np.int64)
+        # the mask selects the token positions in row-major order, which is
+        # the order of the flattened token lists
+        unk_token_id = self.tokenizer.unk_token_id
+        input_ids[input_mask] = [
+            self._vocab.get(token, unk_token_id) for token in itertools.chain.from_iterable(tokens)
+        ]
+        return input_ids, input_mask.astype(np.int64)
+
+    @staticmethod
+    def _truncated_lengths(len_a, len_b, max_length):
+        """Returns the lengths a sequence pair is truncated to, so that the
+            pair fits in max_length tokens."""
+        # This is a simple heuristic which will always truncate the longer
+        # sequence one token at a time. This makes more sense than
+        # truncating an equal percent of tokens from each, since if one
+        # sequence is very short then each token that's truncated likely
+        # contains more information than a longer sequence.
+        if not len_b:
+            max_length += 1
+
+        while len_a + len_b > max_length:
+            if len_a > len_b:
+                len_a -= 1
+            else:
+                len_b -= 1
+
+        return len_a, len_b
 
     def preprocess_encoder_tokens(self, tokens, max_len=BERT_MAX_LEN):
         """Preprocessing of input tokens:
@@ -205,16 +270,18 @@ class Tokenizer:
             token_type_ids = [x + [0] * (max_len - len(x)) for x in token_type_ids]
 
         tokens = [["[CLS]"] + x for x in tokens]
-        # convert tokens to indices
-        input_ids = [self.tokenizer.convert_tokens_to_ids(x) for x in tokens]
-        # pad sequence
-        input_ids = [x + [0] * (max_len - len(x)) for x in input_ids]
-        # create input mask
-        input_mask = [[min(1, x) for x in y] for y in input_ids]
-        return tokens, input_ids, input_mask, token_type_ids
+        # convert tokens to indices, pad sequences and create input mask
+        input_ids, input_mask = self._convert_tokens_to_padded_ids(tokens, max_len)
+        return tokens, input_ids.tolist(), input_mask.tolist(), token_type_ids
 
     def tokenize_ner(
-        self, text, max_len=BERT_MAX_LEN, labels=None, label_map=None, trailing_piece_tag="X"
+        self,
+        text,
+        max_len=BERT_MAX_LEN,
+        labels=None,
+        label_map=None,
+        trailing_piece_tag="X",
+        return_arrays=False,
     ):
         """
         Tokenize and preprocesses input word lists, involving the following steps
@@ -245,9 +312,13 @@ class Tokenizer:
                 word pieces. For example, "criticize" is broken into "critic"
                 and "##ize", "critic" preserves its original label and "##ize"
                 is labeled as trailing_piece_tag. Default value is "X".
+            return_arrays (bool, optional): Whether to return NumPy arrays
+                instead of lists of lists. create_data_loader converts arrays
+                to tensors without copying them. Default value is False.
 
         Returns:
-            tuple: A tuple containing the following four lists.
+            tuple: A tuple containing the following four lists, or arrays if
+                return_arrays is True.
                 1. input_ids_all: List of lists. Each sublist contains
                     numerical values, i.e. token ids, corresponding to the
                     tokens in the input text data.
@@ -268,26 +339,23 @@ class Tokenizer:
                     argument is not provided, the value of this is None.
         """
 
-        def _is_iterable_but_not_string(obj):
-            return isinstance(obj, Iterable) and not isinstance(obj, str)
-
         if max_len > BERT_MAX_LEN:
             warnings.warn("setting max_len to max allowed tokens: {}".format(BERT_MAX_LEN))
             max_len = BERT_MAX_LEN
 
-        if not _is_iterable_but_not_string(text):
-            # The input text must be an non-string Iterable
-            raise ValueError("Input text must be an iterable and not a string.")
+        if not isinstance(text, (list, tuple)):
+            # The input text must be a list or a tuple
+            raise ValueError("Input text must be a list or a tuple.")
         else:
             # If the input text is a single list of words, convert it to
             # list of lists for later iteration
-            if not _is_iterable_but_not_string(text[0]):
+            if not isinstance(text[0], (list, tuple)):
                 text = [text]
         if labels is not None:
-            if not _is_iterable_but_not_string(labels):
-                raise ValueError("labels must be an iterable and not a string.")
+            if not isinstance(labels, (list, tuple)):
+                raise ValueError("labels must be a list or a tuple.")
             else:
-                if not _is_iterable_but_not_string(labels[0]):
+                if not isinstance(labels[0], (list, tuple)):
                     labels = [labels]
 
         label_available = True
@@ -296,11 +364,11 @@ class Tokenizer:
             # create an artificial label list for creating trailing token mask
             labels = [["O"] * len(t) for t in text]
 
-        input_ids_all = []
-        input_mask_all = []
+        tokens_all = []
+        # padded tokens are labeled as "O"
+        trailing_token_mask_all = np.full((len(text), max_len), "O" != trailing_piece_tag)
         label_ids_all = []
-        trailing_token_mask_all = []
-        for t, t_labels in zip(text, labels):
+        for i, (t, t_labels) in enumerate(zip(text, labels)):
 
             if len(t) != len(t_labels):
                 raise ValueError(
@@ -313,7 +381,7 @@ class Tokenizer:
             new_tokens = []
             if label_available:
                 for word, tag in zip(t, t_labels):
-                    sub_words = self.tokenizer.tokenize(word)
+                    sub_words = self._tokenize_word(word)
                     for count, sub_word in enumerate(sub_words):
                         if count > 0:
                             tag = trailing_piece_tag
@@ -321,7 +389,7 @@ class Tokenizer:
                         new_tokens.append(sub_word)
             else:
                 for word in t:
-                    sub_words = self.tokenizer.tokenize(word)
+                    sub_words = self._tokenize_word(word)
                     for count, sub_word in enumerate(sub_words):
                         if count > 0:
                             tag = trailing_piece_tag
@@ -330,42 +398,48 @@ class Tokenizer:
                         new_labels.append(tag)
                         new_tokens.append(sub_word)
 
-            if len(new_tokens) > max_len:
-                new_tokens = new_tokens[:max_len]
-                new_labels = new_labels[:max_len]
-            input_ids = self.tokenizer.convert_tokens_to_ids(new_tokens)
+            new_tokens = new_tokens[:max_len]
+            new_labels = new_labels[:max_len]
+            num_tokens = len(new_tokens)
 
-            # The mask has 1 for real tokens and 0 for padding tokens.
-            # Only real tokens are attended to.
-            input_mask = [1.0] * len(input_ids)
-
-            # Zero-pad up to the max sequence length.
-            padding = [0.0] * (max_len - len(input_ids))
-            label_padding = ["O"] * (max_len - len(input_ids))
-
-            input_ids += padding
-            input_mask += padding
-            new_labels += label_padding
-
-            trailing_token_mask_all.append(
-                [True if label != trailing_piece_tag else False for label in new_labels]
+            tokens_all.append(new_tokens)
+            trailing_token_mask_all[i, :num_tokens] = (
+                np.array(new_labels, dtype=object) != trailing_piece_tag
             )
 
+            new_labels += ["O"] * (max_len - num_tokens)
             if label_map:
                 label_ids = [label_map[label] for label in new_labels]
             else:
                 label_ids = new_labels
 
-            input_ids_all.append(input_ids)
-            input_mask_all.append(input_mask)
             label_ids_all.append(label_ids)
 
+        # The mask has 1 for real tokens and 0 for padding tokens.
+        # Only real tokens are attended to.
+        input_ids_all, input_mask_all = self._convert_tokens_to_padded_ids(tokens_all, max_len)
+
+        if return_arrays:
+            label_ids_all = np.array(label_ids_all)
+        else:
+            input_ids_all = input_ids_all.tolist()
+            input_mask_all = input_mask_all.tolist()
+            trailing_token_mask_all = trailing_token_mask_all.tolist()
+
         if label_available:
             return (input_ids_all, input_mask_all, trailing_token_mask_all, label_ids_all)
         else:
             return input_ids_all, input_mask_all, trailing_token_mask_all, None
 
 
+def _to_long_tensor(values):
+    """Converts a list of lists or an array to a long tensor. An int64 array
+        shares its buffer with the tensor instead of being copied."""
+    if isinstance(values, np.ndarray):
+        return torch.from_numpy(values.astype(np.int64, copy=False))
+    return torch.tensor(values, dtype=torch.long)
+
+
 def create_data_loader(
     input_ids, input_mask, label_ids=None, sample_method="random", batch_size=32
 ):
@@ -373,13 +447,13 @@ def create_data_loader(
     Create a dataloader for sampling and serving data batches.
 
     Args:
-        input_ids (list): List of lists. Each sublist contains numerical
-            values, i.e. token ids, corresponding to the tokens in the input
-            text data.
-        input_mask (list): List of lists. Each sublist contains the attention
-            mask of the input token id list, 1 for input tokens and 0 for
-            padded tokens, so that padded tokens are not attended to.
-        label_ids (list, optional): List of lists of numerical labels,
+        input_ids (list or np.ndarray): List of lists. Each sublist contains
+            numerical values, i.e. token ids, corresponding to the tokens in
+            the input text data.
+        input_mask (list or np.ndarray): List of lists. Each sublist contains
+            the attention mask of the input token id list, 1 for input tokens
+            and 0 for padded tokens, so that padded tokens are not attended to.
+        label_ids (list or np.ndarray, optional): List of lists of numerical labels,
             each sublist contains token labels of a input
             sentence/paragraph. Default value is None.
         sample_method (str, optional): Order of data sampling. Accepted
@@ -392,11 +466,12 @@ def create_data_loader(
             input_mask tensor, and label_ids (if provided) tensor.
 
     """
-    input_ids_tensor = torch.tensor(input_ids, dtype=torch.long)
-    input_mask_tensor = torch.tensor(input_mask, dtype=torch.long)
+    input_ids_tensor = _to_long_tensor(input_ids)
+    input_mask_tensor = _to_long_tensor(input_mask)
 
-    if label_ids:
-        label_ids_tensor = torch.tensor(label_ids, dtype=torch.long)
+    # an empty label list means no labels, like a missing one
+    if label_ids is not None and len(label_ids) > 0:
+        label_ids_tensor = _to_long_tensor(label_ids)
         tensor_data = TensorDataset(input_ids_tensor, input_mask_tensor, label_ids_tensor)
     else:
         tensor_data = TensorDataset(input_ids_tensor, input_mask_tensor)
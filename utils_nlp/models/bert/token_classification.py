@@ -113,14 +113,14 @@ class BERTTokenClassifier:
         Fine-tunes the BERT classifier using the given training data.
 
         Args:
-            token_ids (list): List of lists. Each sublist contains
+            token_ids (list or np.ndarray): List of lists. Each sublist contains
                 numerical token ids corresponding to the tokens in the input
                 text data.
-            input_mask (list): List of lists. Each sublist contains
+            input_mask (list or np.ndarray): List of lists. Each sublist contains
                 the attention mask of the input token id list. 1 for input
                 tokens and 0 for padded tokens, so that padded tokens are
                 not attended to.
-            labels (list): List of lists, each sublist contains numerical
+            labels (list or np.ndarray): List of lists, each sublist contains numerical
                 token labels of an input sentence/paragraph.
             num_gpus (int, optional): The number of GPUs to use.
                 If None, all available GPUs will be used. Defaults to None.
@@ -196,14 +196,14 @@ class BERTTokenClassifier:
         Predict token labels on the testing data.
 
         Args:
-            token_ids (list): List of lists. Each sublist contains
+            token_ids (list or np.ndarray): List of lists. Each sublist contains
                 numerical token ids corresponding to the tokens in the input
                 text data.
-            input_mask (list): List of lists. Each sublist contains
+            input_mask (list or np.ndarray): List of lists. Each sublist contains
                 the attention mask of the input token list, 1 for input
                 tokens and 0 for padded tokens, so that padded tokens are
                 not attended to.
-            labels (list, optional): List of lists. Each sublist contains
+            labels (list or np.ndarray, optional): List of lists. Each sublist contains
                 numerical token labels of an input sentence/paragraph.
                 If provided, it's used to compute the evaluation loss.
                 Default value is None.
@@ -236,7 +236,7 @@ class BERTTokenClassifier:
         for step, batch in enumerate(tqdm(test_dataloader, desc="Iteration", mininterval=10)):
             batch = tuple(t.to(device) for t in batch)
             true_label_available = False
-            if labels:
+            if labels is not None and len(labels) > 0:
                 b_input_ids, b_input_mask, b_labels = batch
                 true_label_available = True
             else:
@@ -299,7 +299,7 @@ def postprocess_token_labels(
 
     Args:
         labels (list): List of lists of predicted token labels.
-        input_mask (list): List of lists. Each sublist contains the attention
+        input_mask (list or np.ndarray): List of lists. Each sublist contains the attention
             mask of the input token list, 1 for input tokens and 0
             for padded tokens.
         label_map (dict, optional): A dictionary mapping original labels
@@ -312,7 +312,7 @@ def postprocess_token_labels(
             "##ize". After removing predicted label for "##ize",
             the predicted label for "critic" is assigned to the original word
             "criticize". Default value is False.
-        trailing_token_mask (list, optional): list of boolean values, True for
+        trailing_token_mask (list or np.ndarray, optional): list of boolean values, True for
             the first word piece of each original word, False for trailing
             word pieces, e.g. ##ize. If remove_trailing_word_pieces is
             True, this mask is used to remove the predicted labels on
@@ -330,7 +330,11 @@ def postprocess_token_labels(
         for label_list, mask_list in zip(labels_org, input_mask)
     ]
 
-    if remove_trailing_word_pieces and trailing_token_mask:
+    if (
+        remove_trailing_word_pieces
+        and trailing_token_mask is not None
+        and len(trailing_token_mask) > 0
+    ):
         # Remove the padded values in trailing_token_mask first
         token_mask_no_padding = [
             [token for token, padding in zip(t_mask, p_mask) if padding == 1]
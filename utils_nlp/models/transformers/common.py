@@ -18,8 +18,8 @@ from transformers.modeling_bert import BERT_PRETRAINED_MODEL_ARCHIVE_MAP
 from transformers.modeling_distilbert import DISTILBERT_PRETRAINED_MODEL_ARCHIVE_MAP
 from transformers.modeling_roberta import ROBERTA_PRETRAINED_MODEL_ARCHIVE_MAP
 from transformers.modeling_xlnet import XLNET_PRETRAINED_MODEL_ARCHIVE_MAP
-from transformers.tokenization_bert import BertTokenizer
-from transformers.tokenization_distilbert import DistilBertTokenizer
+from transformers.tokenization_bert import BertTokenizer, BertTokenizerFast
+from transformers.tokenization_distilbert import DistilBertTokenizer, DistilBertTokenizerFast
 from transformers.tokenization_roberta import RobertaTokenizer
 from transformers.tokenization_xlnet import XLNetTokenizer
 
@@ -40,11 +40,50 @@ TOKENIZER_CLASS.update(
     {k: DistilBertTokenizer for k in DISTILBERT_PRETRAINED_MODEL_ARCHIVE_MAP}
 )
 
+# Rust-backed tokenizers, for the models that have one
+FAST_TOKENIZER_CLASS = {}
+FAST_TOKENIZER_CLASS.update({k: BertTokenizerFast for k in BERT_PRETRAINED_MODEL_ARCHIVE_MAP})
+FAST_TOKENIZER_CLASS.update(
+    {k: DistilBertTokenizerFast for k in DISTILBERT_PRETRAINED_MODEL_ARCHIVE_MAP}
+)
+
 MAX_SEQ_LEN = 512
 
 logger = logging.getLogger(__name__)
 
 
+def load_fast_tokenizer(model_name, to_lower, cache_dir=".", tokenizer_class=None, **kwargs):
+    """Loads a Rust-backed BERT tokenizer that normalizes text like the original
+        BERT tokenizer.
+
+    Args:
+        model_name (str): Name of the pretrained model, or path to a directory
+            containing its vocabulary.
+        to_lower (bool): Whether to convert all letters to lower case during
+            tokenization.
+        cache_dir (str, optional): Directory to cache the tokenizer. Defaults to ".".
+        tokenizer_class (type, optional): A subclass of BertTokenizerFast.
+            Defaults to the class of model_name in FAST_TOKENIZER_CLASS, or
+            BertTokenizerFast if model_name isn't in it.
+        **kwargs: Other keyword arguments of the from_pretrained method of the
+            tokenizer class.
+
+    Returns:
+        BertTokenizerFast: The tokenizer.
+    """
+    if tokenizer_class is None:
+        tokenizer_class = FAST_TOKENIZER_CLASS.get(model_name, BertTokenizerFast)
+    return tokenizer_class.from_pretrained(
+        model_name,
+        do_lower_case=to_lower,
+        # The original BERT tokenizer only strips accents when it lower cases the
+        # text, but the fast tokenizers of transformers 2.x strip them by default.
+        strip_accents=to_lower,
+        cache_dir=cache_dir,
+        **kwargs,
+    )
+
+
 class Transformer:
     def __init__(
         self,
@@ -2,7 +2,7 @@
 # Licensed under the MIT License.
 
 import logging
-from collections import Iterable
+from collections.abc import Iterable
 
 import numpy as np
 import torch
@@ -17,13 +17,19 @@
 # Modifications copyright © Microsoft Corporation
 
 
+import array
 import collections
+import itertools
 import json
 import logging
 import math
+import multiprocessing
 import os
+import pickle
+import re
 
 import jsonlines
+import numpy as np
 import torch
 from torch.utils.data import TensorDataset
 from tqdm import tqdm
@@ -43,6 +49,7 @@ from transformers.modeling_xlnet import (
     XLNET_PRETRAINED_MODEL_ARCHIVE_MAP,
     XLNetForQuestionAnswering,
 )
+from transformers import PreTrainedTokenizerFast
 from transformers.tokenization_bert import BasicTokenizer, whitespace_tokenize
 
 from utils_nlp.common.pytorch_utils import (
@@ -52,9 +59,11 @@ from utils_nlp.common.pytorch_utils import (
     parallelize_model,
 )
 from utils_nlp.models.transformers.common import (
+    FAST_TOKENIZER_CLASS,
     MAX_SEQ_LEN,
     TOKENIZER_CLASS,
     Transformer,
+    load_fast_tokenizer,
 )
 
 MODEL_CLASS = {}
@@ -73,6 +82,37 @@ CACHED_FEATURES_TRAIN_FILE = "cached_features_train.jsonl"
 CACHED_EXAMPLES_TEST_FILE = "cached_examples_test.jsonl"
 CACHED_FEATURES_TEST_FILE = "cached_features_test.jsonl"
 
+# number of QA inputs sent to a feature extraction worker process at a time
+QA_WORKER_CHUNK_SIZE = 64
+
+# fields of _QAFeatures in the tensors of the preprocessed training and testing
+# datasets, in order
+_QA_TRAIN_TENSOR_FIELDS = [
+    "input_ids",
+    "input_mask",
+    "segment_ids",
+    "start_position",
+    "end_position",
+    "cls_index",
+    "p_mask",
+]
+_QA_TEST_TENSOR_FIELDS = [
+    "input_ids",
+    "input_mask",
+    "segment_ids",
+    "cls_index",
+    "p_mask",
+    "unique_id",
+]
+# tensor fields with one value per token of the feature sequence, the other
+# fields have one value per feature
+_QA_SEQUENCE_FIELDS = {"input_ids", "input_mask", "segment_ids", "p_mask"}
+
+# white space characters separating document tokens, and their code points
+_WHITESPACE_CHARS = " \t\r\n\u202f"
+_WHITESPACE_CODES = [ord(c) for c in _WHITESPACE_CHARS]
+_DOC_TOKEN_PATTERN = re.compile("[^{}]+".format(_WHITESPACE_CHARS))
+
 logger = logging.getLogger(__name__)
 
 
@@ -106,9 +146,9 @@ class QAProcessor:
         self, model_name="bert-base-cased", to_lower=False, custom_tokenize=None, cache_dir=".",
     ):
         self.model_name = model_name
-        self.tokenizer = TOKENIZER_CLASS[model_name].from_pretrained(
-            model_name, do_lower_case=to_lower, cache_dir=cache_dir, output_loading_info=False,
-        )
+        # the worker processes of preprocess load the same tokenizer
+        self._tokenizer_args = (model_name, to_lower, cache_dir)
+        self.tokenizer = _load_qa_tokenizer(*self._tokenizer_args)
         self.do_lower_case = to_lower
         self.custom_tokenize = custom_tokenize
 
@@ -180,6 +220,7 @@ class QAProcessor:
         max_seq_length=MAX_SEQ_LEN,
         doc_stride=128,
         feature_cache_dir="./cached_qa_features",
+        num_workers=1,
     ):
         """
         Preprocesses raw question answering data and generates train/test features.
@@ -210,10 +251,32 @@ class QAProcessor:
                 to this directory. These files are required during postprocessing to
                 generate the final answer texts from predicted answer start and answer
                 end indices. Defaults to "./cached_qa_features".
+            num_workers (int, optional): Number of processes used to extract the
+                features. The examples are independent of each other, so they are
+                split across the processes. If None, all available CPUs are used.
+                The worker processes are started with the "spawn" method, which
+                is safe after the fast tokenizers have used their own threads, and
+                each of them loads the tokenizer of the model from `cache_dir`.
+                Starting them takes a few seconds, so more than one worker only
+                pays off on large datasets. When num_workers is not 1,
+                `custom_tokenize` must be picklable, e.g. a function defined at the
+                top level of a module, and scripts must guard their entry point
+                with `if __name__ == "__main__":`. Defaults to 1.
         Returns:
             DataSet: A Pytorch DataSet.
         """
 
+        if num_workers is not None and num_workers < 1:
+            raise ValueError("num_workers must be None or a positive integer.")
+
+        if num_workers != 1 and self.custom_tokenize:
+            try:
+                pickle.dumps(self.custom_tokenize)
+            except (pickle.PicklingError, AttributeError, TypeError) as e:
+                raise ValueError(
+                    "custom_tokenize must be picklable when num_workers is not 1."
+                ) from e
+
         if not os.path.exists(feature_cache_dir):
             os.makedirs(feature_cache_dir)
 
@@ -231,16 +294,55 @@ class QAProcessor:
             features_file, "w"
         ) as features_writer:
 
-            unique_id_all = []
             unique_id_cur = 1000000000
 
-            features = []
+            # The numerical features are stored field by field, ready to be stacked
+            # into tensors. The other fields are only saved for postprocessing.
+            # Each field is a flat buffer of 64-bit integers instead of a list of
+            # lists, so a value takes 8 bytes instead of a pointer to an int object.
+            if is_training:
+                tensor_fields = _QA_TRAIN_TENSOR_FIELDS
+            else:
+                tensor_fields = _QA_TEST_TENSOR_FIELDS
+            feature_values = {field: array.array("q") for field in tensor_fields}
+            num_features = 0
+
             qa_examples = []
             qa_examples_json = []
             features_json = []
 
-            for qa_input in qa_dataset:
-                qa_example_cur = _create_qa_example(qa_input, is_training=is_training)
+            feature_args = {
+                "is_training": is_training,
+                "model_type": self.model_type,
+                "tokenizer": self.tokenizer,
+                "max_question_length": max_question_length,
+                "max_seq_length": max_seq_length,
+                "doc_stride": doc_stride,
+                "custom_tokenize": self.custom_tokenize,
+                # WordPiece tokens of document words, shared across examples
+                "wordpiece_cache": {},
+            }
+
+            qa_inputs = list(qa_dataset)
+            if not self.custom_tokenize and isinstance(
+                self.tokenizer, PreTrainedTokenizerFast
+            ):
+                # all questions are tokenized with a single call to the fast tokenizer
+                all_query_tokens, all_query_ids = _tokenize_questions(
+                    self.tokenizer, [x.question_text for x in qa_inputs], max_question_length,
+                )
+            else:
+                # the questions are tokenized with the documents
+                all_query_tokens = all_query_ids = itertools.repeat(None)
+
+            for qa_example_cur, features_cur in _map_qa_inputs(
+                zip(qa_inputs, all_query_tokens, all_query_ids),
+                feature_args,
+                num_workers,
+                tokenizer_args=self._tokenizer_args,
+            ):
+                if qa_example_cur is None:
+                    continue
 
                 qa_examples.append(qa_example_cur)
 
@@ -248,18 +350,11 @@ class QAProcessor:
                     {"qa_id": qa_example_cur.qa_id, "doc_tokens": qa_example_cur.doc_tokens}
                 )
 
-                features_cur = _create_qa_features(
-                    qa_example_cur,
-                    model_type=self.model_type,
-                    tokenizer=self.tokenizer,
-                    unique_id=unique_id_cur,
-                    is_training=is_training,
-                    max_question_length=max_question_length,
-                    max_seq_length=max_seq_length,
-                    doc_stride=doc_stride,
-                    custom_tokenize=self.custom_tokenize,
-                )
-                features += features_cur
+                # the unique ids of the features of an example are numbered from 0,
+                # offset them by the last unique id assigned
+                features_cur = [
+                    f._replace(unique_id=unique_id_cur + f.unique_id) for f in features_cur
+                ]
 
                 for f in features_cur:
                     features_json.append(
@@ -272,8 +367,13 @@ class QAProcessor:
                             "paragraph_len": f.paragraph_len,
                         }
                     )
+                    for field in tensor_fields:
+                        if field in _QA_SEQUENCE_FIELDS:
+                            feature_values[field].extend(getattr(f, field))
+                        else:
+                            feature_values[field].append(getattr(f, field))
                     unique_id_cur = f.unique_id
-                    unique_id_all.append(unique_id_cur)
+                    num_features += 1
 
             examples_writer.write_all(qa_examples_json)
             features_writer.write_all(features_json)
@@ -281,30 +381,13 @@ class QAProcessor:
             logger.info("QA examples are saved to {}".format(examples_file))
             logger.info("QA features are saved to {}".format(features_file))
 
-        # TODO: maybe generalize the following code
-        input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-        input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-        segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
-        cls_index = torch.tensor([f.cls_index for f in features], dtype=torch.long)
-        p_mask = torch.tensor([f.p_mask for f in features], dtype=torch.long)
-
-        if is_training:
-            start_positions = torch.tensor([f.start_position for f in features], dtype=torch.long)
-            end_positions = torch.tensor([f.end_position for f in features], dtype=torch.long)
-            qa_dataset = TensorDataset(
-                input_ids,
-                input_mask,
-                segment_ids,
-                start_positions,
-                end_positions,
-                cls_index,
-                p_mask,
-            )
-        else:
-            unique_id_all = torch.tensor(unique_id_all, dtype=torch.long)
-            qa_dataset = TensorDataset(
-                input_ids, input_mask, segment_ids, cls_index, p_mask, unique_id_all
-            )
+        tensors = []
+        for field in tensor_fields:
+            values = np.frombuffer(feature_values[field], dtype=np.int64)
+            if field in _QA_SEQUENCE_FIELDS:
+                values = values.reshape(num_features, max_seq_length)
+            tensors.append(torch.from_numpy(values))
+        qa_dataset = TensorDataset(*tensors)
 
         return qa_dataset
 
@@ -1233,49 +1316,183 @@ def postprocess_xlnet_answer(
 
 # -------------------------------------------------------------------------------------------------
 # Preprocessing helper functions
-def _is_iterable_but_not_string(obj):
-    """Check whether obj is a non-string Iterable."""
-    return isinstance(obj, collections.Iterable) and not isinstance(obj, str)
+# _QAExample is a data structure representing an unique document-question-answer
+#   triplet.
+# Args:
+#     qa_id (int): An unique id identifying the document-question pair.
+#         This is used to map prediction results to ground truth answers
+#         during evaluation, because the data order is not preserved
+#         during pre-processing and post-processing.
+#     doc_tokens (list): White-space tokenized tokens of the document
+#         text. This is used to generate the final answer based on
+#         predicted start and end token indices during post-processing.
+#     question_text (str): Text of the question.
+#     orig_answer_text (str): Text of the ground truth answer if available.
+#     start_position (int): Index of the starting token of the answer
+#         span, if available.
+#     end_position (int): Index of the ending token of the answer span,
+#         if available.
+#     is_impossible (bool): If the question is impossible to answer based
+#         on the given document.
+_QAExample = collections.namedtuple(
+    "_QAExample",
+    [
+        "qa_id",
+        "doc_tokens",
+        "question_text",
+        "orig_answer_text",
+        "start_position",
+        "end_position",
+        "is_impossible",
+    ],
+)
 
 
-def _create_qa_example(qa_input, is_training):
-    """ Initial preprocessing to create _QAExample for feature extraction. """
+# _QAFeatures is data structure representing features of an unique document
+# span-question-answer triplet.
+# Args:
+#     unique_id (int): An unique id identifying the span-question-answer triplet.
+#     qa_id (int or str):  An unique id identifying the document-question-answer
+#     sample in the original :class:`utils_nlp.dataset.pytorch.QADataset`
+#     tokens (list): Concatenated question tokens and paragraph tokens.
+#     token_to_orig_map (dict): A dictionary mapping token indices in the
+#         document span back to the token indices in the original document
+#         before document splitting.
+#         This is needed during post-processing to generate the final
+#         predicted answer.
+#     token_is_max_context (list): List of booleans indicating whether a
+#         token has the maximum context in teh current document span if it
+#         appears in multiple document spans and gets multiple predicted
+#         scores. We only want to consider the score with "maximum context".
+#         "Maximum context" is defined as the *minimum* of its left and
+#         right context.
+#         For example:
+#             Doc: the man went to the store and bought a gallon of milk
+#             Span A: the man went to the
+#             Span B: to the store and bought
+#             Span C: and bought a gallon of
+#
+#         In the example the maximum context for 'bought' would be span C
+#         since it has 1 left context and 3 right context, while span B
+#         has 4 left context and 0 right context.
+#         This is needed during post-processing to generate the final
+#         predicted answer.
+#     input_ids (list): List of numerical token indices corresponding to
+#         the tokens.
+#     input_mask (list): List of 1s and 0s indicating if a token is from
+#         the input data or padded to conform to the maximum sequence
+#         length. 1 for actual token and 0 for padded token.
+#     segment_ids (list): List of 0s and 1s indicating if a token is from
+#         the question text (0) or paragraph text (1).
+#     start_position (int): Index of the starting token of the answer span.
+#     end_position (int): Index of the ending token of the answer span.
+#     cls_index (int): Index of the CLS token.
+#     p_mask (list): Mask with 1 for token than cannot be in the answer,
+#     0 for token which can be in an answer.
+#     paragraph_len(int): Number of tokens in the document span.
+_QAFeatures = collections.namedtuple(
+    "_QAFeatures",
+    [
+        "unique_id",
+        "qa_id",
+        "tokens",
+        "token_to_orig_map",
+        "token_is_max_context",
+        "input_ids",
+        "input_mask",
+        "segment_ids",
+        "start_position",
+        "end_position",
+        "cls_index",
+        "p_mask",
+        "paragraph_len",
+    ],
+)
+
+
+# Keyword arguments of _create_qa_example_and_features in the worker processes,
+# set by _init_qa_worker.
+_qa_worker_args = None
+
+
+def _load_qa_tokenizer(model_name, to_lower, cache_dir):
+    """Loads the tokenizer of a QA model. The fast tokenizer of the model is used if
+        there is one, so that documents can be tokenized in a single call, see
+        _tokenize_doc_with_offsets.
+    """
+    if model_name in FAST_TOKENIZER_CLASS:
+        return load_fast_tokenizer(
+            model_name, to_lower, cache_dir=cache_dir, output_loading_info=False
+        )
+    return TOKENIZER_CLASS[model_name].from_pretrained(
+        model_name, do_lower_case=to_lower, cache_dir=cache_dir, output_loading_info=False,
+    )
+
 
-    # _QAExample is a data structure representing an unique document-question-answer
-    #   triplet.
-    # Args:
-    #     qa_id (int): An unique id identifying the document-question pair.
-    #         This is used to map prediction results to ground truth answers
-    #         during evaluation, because the data order is not preserved
-    #         during pre-processing and post-processing.
-    #     doc_tokens (list): White-space tokenized tokens of the document
-    #         text. This is used to generate the final answer based on
-    #         predicted start and end token indices during post-processing.
-    #     question_text (str): Text of the question.
-    #     orig_answer_text (str): Text of the ground truth answer if available.
-    #     start_position (int): Index of the starting token of the answer
-    #         span, if available.
-    #     end_position (int): Index of the ending token of the answer span,
-    #         if available.
-    #     is_impossible (bool): If the question is impossible to answer based
-    #         on the given document.
-    _QAExample = collections.namedtuple(
-        "_QAExample",
-        [
-            "qa_id",
-            "doc_tokens",
-            "question_text",
-            "orig_answer_text",
-            "start_position",
-            "end_position",
-            "is_impossible",
-        ],
+def _init_qa_worker(tokenizer_args, feature_args):
+    """Loads the tokenizer and stores the feature extraction arguments in a worker
+        process."""
+    global _qa_worker_args
+    _qa_worker_args = dict(feature_args, tokenizer=_load_qa_tokenizer(*tokenizer_args))
+
+
+def _qa_worker(qa_input_and_query):
+    qa_input, query_tokens, query_ids = qa_input_and_query
+    return _create_qa_example_and_features(
+        qa_input, query_tokens=query_tokens, query_ids=query_ids, **_qa_worker_args
     )
 
-    def _is_whitespace(c):
-        if c == " " or c == "\t" or c == "\r" or c == "\n" or ord(c) == 0x202F:
-            return True
-        return False
+
+def _map_qa_inputs(qa_inputs, feature_args, num_workers=1, tokenizer_args=None):
+    """Yields the _QAExample and the list of _QAFeatures of each QA input, in order.
+        `qa_inputs` is an iterable of (QA input, question tokens, question token ids)
+        triples, where the question tokens and ids are None if the question isn't
+        tokenized yet.
+        If num_workers is not 1, the inputs are processed by a pool of worker
+        processes, which load the tokenizer from `tokenizer_args` instead of using
+        the tokenizer in `feature_args`.
+    """
+    if num_workers == 1:
+        for qa_input, query_tokens, query_ids in qa_inputs:
+            yield _create_qa_example_and_features(
+                qa_input, query_tokens=query_tokens, query_ids=query_ids, **feature_args
+            )
+    else:
+        # Forked workers can deadlock or lose the parallelism of a fast tokenizer
+        # that has already run in the parent, and tokenizers aren't reliably
+        # picklable, so the workers are spawned and load their own tokenizer.
+        # The other arguments are passed to each worker once instead of with
+        # every input.
+        worker_args = {k: v for k, v in feature_args.items() if k != "tokenizer"}
+        with multiprocessing.get_context("spawn").Pool(
+            num_workers, initializer=_init_qa_worker, initargs=(tokenizer_args, worker_args)
+        ) as pool:
+            yield from pool.imap(_qa_worker, qa_inputs, chunksize=QA_WORKER_CHUNK_SIZE)
+
+
+def _create_qa_example_and_features(
+    qa_input, is_training, query_tokens=None, query_ids=None, **kwargs
+):
+    """Creates the _QAExample of a QA input and extracts its list of _QAFeatures.
+        The unique ids of the features are numbered from 0. If the answer can't be
+        found in the document of a training example, (None, []) is returned.
+    """
+    qa_example = _create_qa_example(qa_input, is_training=is_training)
+    if qa_example is None:
+        return None, []
+    qa_features = _create_qa_features(
+        qa_example,
+        unique_id=0,
+        is_training=is_training,
+        query_tokens=query_tokens,
+        query_ids=query_ids,
+        **kwargs,
+    )
+    return qa_example, qa_features
+
+
+def _create_qa_example(qa_input, is_training):
+    """ Initial preprocessing to create _QAExample for feature extraction. """
 
     d_text = qa_input.doc_text
     q_text = qa_input.question_text
@@ -1284,22 +1501,20 @@ def _create_qa_example(qa_input, is_training):
     q_id = qa_input.qa_id
     impossible = qa_input.is_impossible
 
-    d_tokens = []
-    char_to_word_offset = []
-    prev_is_whitespace = True
-    for c in d_text:
-        if _is_whitespace(c):
-            prev_is_whitespace = True
-        else:
-            if prev_is_whitespace:
-                d_tokens.append(c)
-            else:
-                d_tokens[-1] += c
-            prev_is_whitespace = False
-        char_to_word_offset.append(len(d_tokens) - 1)
+    d_tokens = _DOC_TOKEN_PATTERN.findall(d_text)
+
+    # A token starts at each character that is not a white space and follows a white
+    # space or the beginning of the document, so the number of token starts up to a
+    # character is the index of its token plus one. White spaces at the beginning of
+    # the document map to -1.
+    d_codes = np.frombuffer(d_text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+    is_whitespace = np.isin(d_codes, _WHITESPACE_CODES)
+    is_token_start = ~is_whitespace
+    is_token_start[1:] &= is_whitespace[:-1]
+    char_to_word_offset = np.cumsum(is_token_start) - 1
 
-    if _is_iterable_but_not_string(a_start):
-        if not _is_iterable_but_not_string(a_text):
+    if isinstance(a_start, (list, tuple)):
+        if not isinstance(a_text, (list, tuple)):
             raise Exception("The answer text must be a list when answer start is a list.")
         if len(a_start) != 1 and is_training and not impossible:
             raise Exception("For training, each question should have exactly 1 answer.")
@@ -1311,8 +1526,8 @@ def _create_qa_example(qa_input, is_training):
     if is_training:
         if not impossible:
             answer_length = len(a_text)
-            start_position = char_to_word_offset[a_start]
-            end_position = char_to_word_offset[a_start + answer_length - 1]
+            start_position = int(char_to_word_offset[a_start])
+            end_position = int(char_to_word_offset[a_start + answer_length - 1])
             # Only add answers where the text can be exactly recovered from the
             # document. If this CAN'T happen it's likely due to weird Unicode
             # stuff so we will just skip the example.
@@ -1341,6 +1556,105 @@ def _create_qa_example(qa_input, is_training):
     )
 
 
+def _tokenize_doc_with_offsets(tokenizer, doc_tokens):
+    """Tokenizes the white-space tokens of a document with a single call to a fast
+        tokenizer, and maps the word-piece tokens back to the white-space tokens
+        through the character offsets returned by the tokenizer.
+
+    Returns:
+        tuple: A tuple containing the following four lists
+            word-piece tokens of the document
+            index of the original token of each word-piece token
+            index of the first word-piece token of each original token
+            ids of the word-piece tokens
+    """
+    # start character of each original token in the white-space joined document
+    token_lengths = np.array([len(t) for t in doc_tokens], dtype=np.int64)
+    token_starts = np.cumsum(token_lengths + 1) - token_lengths - 1
+
+    encoding = tokenizer.batch_encode_plus(
+        [" ".join(doc_tokens)],
+        add_special_tokens=False,
+        return_token_type_ids=False,
+        return_attention_mask=False,
+        return_offsets_mapping=True,
+    )
+    sub_token_starts = np.array(
+        [start for (start, _) in encoding["offset_mapping"][0]], dtype=np.int64
+    )
+
+    # The word-piece tokens never cross white spaces, so the original token of a
+    # word-piece token is the last one starting at or before it.
+    tok_to_orig_index = np.searchsorted(token_starts, sub_token_starts, side="right") - 1
+    # Original tokens without word-piece tokens map to the next word-piece token.
+    orig_to_tok_index = np.searchsorted(tok_to_orig_index, np.arange(len(doc_tokens)))
+
+    doc_ids = encoding["input_ids"][0]
+
+    return (
+        tokenizer.convert_ids_to_tokens(doc_ids),
+        tok_to_orig_index.tolist(),
+        orig_to_tok_index.tolist(),
+        doc_ids,
+    )
+
+
+def _tokenize_doc_by_word(tokenize_func, doc_tokens, wordpiece_cache):
+    """Tokenizes the white-space tokens of a document one by one. The word-piece
+        tokens of new words are added to `wordpiece_cache`, a dictionary mapping
+        words to their tokens.
+
+    Returns:
+        tuple: A tuple containing the following three lists
+            word-piece tokens of the document
+            index of the original token of each word-piece token
+            index of the first word-piece token of each original token
+    """
+    sub_tokens_per_word = []
+    for token in doc_tokens:
+        sub_tokens = wordpiece_cache.get(token)
+        if sub_tokens is None:
+            sub_tokens = tokenize_func(token)
+            wordpiece_cache[token] = sub_tokens
+        sub_tokens_per_word.append(sub_tokens)
+    all_doc_tokens = list(itertools.chain.from_iterable(sub_tokens_per_word))
+
+    num_sub_tokens = np.fromiter(
+        map(len, sub_tokens_per_word), dtype=np.int64, count=len(sub_tokens_per_word)
+    )
+    # map word-piece tokens to original tokens
+    tok_to_orig_index = np.repeat(np.arange(len(sub_tokens_per_word)), num_sub_tokens)
+    # map original tokens to corresponding word-piece tokens
+    orig_to_tok_index = np.cumsum(num_sub_tokens) - num_sub_tokens
+
+    return all_doc_tokens, tok_to_orig_index.tolist(), orig_to_tok_index.tolist()
+
+
+def _tokenize_questions(tokenizer, questions, max_question_length):
+    """Tokenizes a list of questions with a single call to a fast tokenizer, and
+        truncates the tokens of each question to max_question_length.
+
+    Returns:
+        tuple: A tuple containing the following two lists
+            list of the tokens of each question
+            list of the token ids of each question
+    """
+    questions = list(questions)
+    # batch_encode_plus fails on an empty batch
+    if not questions:
+        return [], []
+
+    encoding = tokenizer.batch_encode_plus(
+        questions,
+        add_special_tokens=False,
+        return_token_type_ids=False,
+        return_attention_mask=False,
+    )
+    all_query_ids = [ids[:max_question_length] for ids in encoding["input_ids"]]
+    all_query_tokens = [tokenizer.convert_ids_to_tokens(ids) for ids in all_query_ids]
+    return all_query_tokens, all_query_ids
+
+
 def _create_qa_features(
     example,
     model_type,
@@ -1351,77 +1665,27 @@ def _create_qa_features(
     max_seq_length,
     doc_stride,
     custom_tokenize=None,
+    wordpiece_cache=None,
+    query_tokens=None,
+    query_ids=None,
 ):
     """Extracts features for model training and scoring from document-question-answer
         triplet.
+        `wordpiece_cache` is an optional dictionary mapping document words to their
+        tokens, which can be shared across examples to avoid re-tokenizing words.
+        `query_tokens` and `query_ids` are the optional tokens of the question and
+        their ids, already truncated to max_question_length. If not provided, the
+        question is tokenized and its tokens are converted to ids here.
     """
 
-    # _QAFeatures is data structure representing features of an unique document
-    # span-question-answer triplet.
-    # Args:
-    #     unique_id (int): An unique id identifying the span-question-answer triplet.
-    #     qa_id (int or str):  An unique id identifying the document-question-answer
-    #     sample in the original :class:`utils_nlp.dataset.pytorch.QADataset`
-    #     tokens (list): Concatenated question tokens and paragraph tokens.
-    #     token_to_orig_map (dict): A dictionary mapping token indices in the
-    #         document span back to the token indices in the original document
-    #         before document splitting.
-    #         This is needed during post-processing to generate the final
-    #         predicted answer.
-    #     token_is_max_context (list): List of booleans indicating whether a
-    #         token has the maximum context in teh current document span if it
-    #         appears in multiple document spans and gets multiple predicted
-    #         scores. We only want to consider the score with "maximum context".
-    #         "Maximum context" is defined as the *minimum* of its left and
-    #         right context.
-    #         For example:
-    #             Doc: the man went to the store and bought a gallon of milk
-    #             Span A: the man went to the
-    #             Span B: to the store and bought
-    #             Span C: and bought a gallon of
-
-    #         In the example the maximum context for 'bought' would be span C
-    #         since it has 1 left context and 3 right context, while span B
-    #         has 4 left context and 0 right context.
-    #         This is needed during post-processing to generate the final
-    #         predicted answer.
-    #     input_ids (list): List of numerical token indices corresponding to
-    #         the tokens.
-    #     input_mask (list): List of 1s and 0s indicating if a token is from
-    #         the input data or padded to conform to the maximum sequence
-    #         length. 1 for actual token and 0 for padded token.
-    #     segment_ids (list): List of 0s and 1s indicating if a token is from
-    #         the question text (0) or paragraph text (1).
-    #     start_position (int): Index of the starting token of the answer span.
-    #     end_position (int): Index of the ending token of the answer span.
-    #     cls_index (int): Index of the CLS token.
-    #     p_mask (list): Mask with 1 for token than cannot be in the answer,
-    #     0 for token which can be in an answer.
-    #     paragraph_len(int): Number of tokens in the document span.
-    _QAFeatures = collections.namedtuple(
-        "_QAFeatures",
-        [
-            "unique_id",
-            "qa_id",
-            "tokens",
-            "token_to_orig_map",
-            "token_is_max_context",
-            "input_ids",
-            "input_mask",
-            "segment_ids",
-            "start_position",
-            "end_position",
-            "cls_index",
-            "p_mask",
-            "paragraph_len",
-        ],
-    )
-
     if custom_tokenize:
         tokenize_func = custom_tokenize
     else:
         tokenize_func = tokenizer.tokenize
 
+    if wordpiece_cache is None:
+        wordpiece_cache = {}
+
     def _improve_answer_span(doc_tokens, input_start, input_end, orig_answer_text):
         """Returns tokenized answer spans that better match the annotated answer."""
 
@@ -1447,18 +1711,21 @@ def _create_qa_features(
         # the word "Japanese". Since our WordPiece tokenizer does not split
         # "Japanese", we just use "Japanese" as the annotation. This is fairly rare,
         # but does happen.
-        tok_answer_text = " ".join(tokenize_func(orig_answer_text))
+        #
+        # A matching span has exactly as many tokens as the tokenized answer, so
+        # we only need to slide a window of that length over the input span.
+        tok_answer = list(tokenize_func(orig_answer_text))
+        answer_length = len(tok_answer)
 
-        for new_start in range(input_start, input_end + 1):
-            for new_end in range(input_end, new_start - 1, -1):
-                text_span = " ".join(doc_tokens[new_start : (new_end + 1)])
-                if text_span == tok_answer_text:
-                    return (new_start, new_end)
+        if answer_length > 0:
+            for new_start in range(input_start, input_end - answer_length + 2):
+                if doc_tokens[new_start : (new_start + answer_length)] == tok_answer:
+                    return (new_start, new_start + answer_length - 1)
 
         return (input_start, input_end)
 
-    def _check_is_max_context(doc_spans, cur_span_index, position):
-        """Check if this is the 'max context' doc span for the token."""
+    def _get_max_context_span_indices(doc_spans, num_tokens):
+        """Returns the index of the 'max context' doc span for each token."""
 
         # Because of the sliding window approach taken to scoring documents, a single
         # token can appear in multiple documents. E.g.
@@ -1476,26 +1743,29 @@ def _create_qa_features(
         # In the example the maximum context for 'bought' would be span C since
         # it has 1 left context and 3 right context, while span B has 4 left context
         # and 0 right context.
-        best_score = None
-        best_span_index = None
+        #
+        # The best span of a token doesn't depend on the span being built, so it's
+        # computed once for all tokens with a single pass over the doc spans.
+        best_scores = [None] * num_tokens
+        best_span_indices = [None] * num_tokens
         for (span_index, doc_span) in enumerate(doc_spans):
             end = doc_span.start + doc_span.length - 1
-            if position < doc_span.start:
-                continue
-            if position > end:
-                continue
-            num_left_context = position - doc_span.start
-            num_right_context = end - position
-            score = min(num_left_context, num_right_context) + 0.01 * doc_span.length
-            if best_score is None or score > best_score:
-                best_score = score
-                best_span_index = span_index
+            for position in range(doc_span.start, end + 1):
+                num_left_context = position - doc_span.start
+                num_right_context = end - position
+                score = min(num_left_context, num_right_context) + 0.01 * doc_span.length
+                if best_scores[position] is None or score > best_scores[position]:
+                    best_scores[position] = score
+                    best_span_indices[position] = span_index
 
-        return cur_span_index == best_span_index
+        return best_span_indices
 
     cls_token = "[CLS]"
     sep_token = "[SEP]"
     pad_token = 0
+    # The ids of the special tokens are looked up once instead of converting
+    # them with the other tokens of every doc span.
+    cls_token_id, sep_token_id = tokenizer.convert_tokens_to_ids([cls_token, sep_token])
     sequence_a_segment_id = 0
     sequence_b_segment_id = 1
     mask_padding_with_zero = True
@@ -1516,21 +1786,26 @@ def _create_qa_features(
     # from qa_id in that each qa_example can be broken down into
     # multiple feature samples if the paragraph length is longer than
     # maximum sequence length allowed
-    query_tokens = tokenize_func(example.question_text)
-
-    if len(query_tokens) > max_question_length:
-        query_tokens = query_tokens[0:max_question_length]
-    # map word-piece tokens to original tokens
-    tok_to_orig_index = []
-    # map original tokens to corresponding word-piece tokens
-    orig_to_tok_index = []
-    all_doc_tokens = []
-    for (i, token) in enumerate(example.doc_tokens):
-        orig_to_tok_index.append(len(all_doc_tokens))
-        sub_tokens = tokenize_func(token)
-        for sub_token in sub_tokens:
-            tok_to_orig_index.append(i)
-            all_doc_tokens.append(sub_token)
+    if query_tokens is None:
+        query_tokens = tokenize_func(example.question_text)
+
+        if len(query_tokens) > max_question_length:
+            query_tokens = query_tokens[0:max_question_length]
+    if query_ids is None:
+        query_ids = tokenizer.convert_tokens_to_ids(query_tokens)
+
+    if not custom_tokenize and isinstance(tokenizer, PreTrainedTokenizerFast):
+        (
+            all_doc_tokens,
+            tok_to_orig_index,
+            orig_to_tok_index,
+            all_doc_ids,
+        ) = _tokenize_doc_with_offsets(tokenizer, example.doc_tokens)
+    else:
+        all_doc_tokens, tok_to_orig_index, orig_to_tok_index = _tokenize_doc_by_word(
+            tokenize_func, example.doc_tokens, wordpiece_cache
+        )
+        all_doc_ids = tokenizer.convert_tokens_to_ids(all_doc_tokens)
 
     tok_start_position = None
     tok_end_position = None
@@ -1570,6 +1845,8 @@ def _create_qa_features(
             break
         start_offset += min(length, doc_stride)
 
+    max_context_span_indices = _get_max_context_span_indices(doc_spans, len(all_doc_tokens))
+
     for (doc_span_index, doc_span) in enumerate(doc_spans):
         if is_training:
             unique_id += 1
@@ -1577,6 +1854,7 @@ def _create_qa_features(
             unique_id += 2
 
         tokens = []
+        input_ids = []
         token_to_orig_map = {}
         token_is_max_context = {}
         segment_ids = []
@@ -1590,6 +1868,7 @@ def _create_qa_features(
         # CLS token at the beginning
         if not cls_token_at_end:
             tokens.append(cls_token)
+            input_ids.append(cls_token_id)
             segment_ids.append(cls_token_segment_id)
             p_mask.append(0)
             cls_index = 0
@@ -1599,55 +1878,60 @@ def _create_qa_features(
         if model_type != "xlnet":
             # Query
             tokens += query_tokens
+            input_ids += query_ids
             segment_ids += [sequence_a_segment_id] * len(query_tokens)
             p_mask += [1] * len(query_tokens)
 
             # SEP token
             tokens.append(sep_token)
+            input_ids.append(sep_token_id)
             segment_ids.append(sequence_a_segment_id)
             p_mask.append(1)
 
         # Paragraph
+        paragraph_start = len(tokens)
         for i in range(doc_span.length):
             split_token_index = doc_span.start + i
-            token_to_orig_map[len(tokens)] = tok_to_orig_index[split_token_index]
-
-            ## TODO: maybe this can be improved to compute
-            # is_max_context for each token only once.
-            is_max_context = _check_is_max_context(doc_spans, doc_span_index, split_token_index)
-            token_is_max_context[len(tokens)] = is_max_context
-            tokens.append(all_doc_tokens[split_token_index])
-            if model_type == "xlnet":
-                segment_ids.append(sequence_a_segment_id)
-            else:
-                segment_ids.append(sequence_b_segment_id)
-            p_mask.append(0)
+            token_to_orig_map[paragraph_start + i] = tok_to_orig_index[split_token_index]
+
+            is_max_context = max_context_span_indices[split_token_index] == doc_span_index
+            token_is_max_context[paragraph_start + i] = is_max_context
+        paragraph_end = doc_span.start + doc_span.length
+        tokens += all_doc_tokens[doc_span.start : paragraph_end]
+        input_ids += all_doc_ids[doc_span.start : paragraph_end]
+        if model_type == "xlnet":
+            segment_ids += [sequence_a_segment_id] * doc_span.length
+        else:
+            segment_ids += [sequence_b_segment_id] * doc_span.length
+        p_mask += [0] * doc_span.length
         paragraph_len = doc_span.length
 
         if model_type == "xlnet":
             # SEP token
             tokens.append(sep_token)
+            input_ids.append(sep_token_id)
             segment_ids.append(sequence_a_segment_id)
             p_mask.append(1)
 
             tokens += query_tokens
+            input_ids += query_ids
             segment_ids += [sequence_b_segment_id] * len(query_tokens)
             p_mask += [1] * len(query_tokens)
 
         # SEP token
         tokens.append(sep_token)
+        input_ids.append(sep_token_id)
         segment_ids.append(sequence_b_segment_id)
         p_mask.append(1)
 
         # CLS token at the end
         if cls_token_at_end:
             tokens.append(cls_token)
+            input_ids.append(cls_token_id)
             segment_ids.append(cls_token_segment_id)
             p_mask.append(0)
             cls_index = len(tokens) - 1  # Index of classification token
 
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
         # The mask has 1 for real tokens and 0 for padding tokens. Only real
         # tokens are attended to.
         input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
@@ -1712,7 +1996,7 @@ def _create_qa_features(
             )
         )
 
-        return qa_features
+    return qa_features
 
 
 # Preprocessing helper functions end